@@ -1,3 +1,4 @@
 from structured_templates.engine import TemplateEngine
+from structured_templates.types import CompiledTemplate
 
-__all__ = ["TemplateEngine"]
+__all__ = ["CompiledTemplate", "TemplateEngine"]
@@ -1,20 +1,23 @@
 from __future__ import annotations
 from collections import ChainMap
-from dataclasses import dataclass, field
 from typing import Any, Generic
 
 from structured_templates.types import T_Value
 from structured_templates.exceptions import TemplateError
 
 
-@dataclass
 class Context(Generic[T_Value]):
     """
     A context object holds a value for processing in the template with additional contextual information, such
     as the parent context and key from which the value was retrieved.
+
+    Contexts are created for almost every value in a template, so this is a plain class with `__slots__` rather
+    than a dataclass to keep allocation and attribute access cheap.
     """
 
-    parent: Context | None = field(repr=False)
+    __slots__ = ("_scope_maps", "data", "key", "parent", "scope")
+
+    parent: Context | None
     """ The parent context. """
 
     key: str | int | None
@@ -23,11 +26,28 @@ class Context(Generic[T_Value]):
     data: T_Value
     """ The data of the context. """
 
-    scope: dict[str, Any] | None = field(default_factory=dict)
-    """ Variables that are available to expressions in this context. """
-
-    def __post_init__(self) -> None:
-        assert self.parent is None or self.key is not None, "The key must be provided if the parent is provided."
+    scope: dict[str, Any] | None
+    """ Variables that are available to expressions in this context. Most contexts have none, hence `None`. """
+
+    _scope_maps: list[dict[str, Any]] | None
+    """ Cache for [scope_maps()]. """
+
+    def __init__(
+        self,
+        parent: Context | None,
+        key: str | int | None,
+        data: T_Value,
+        scope: dict[str, Any] | None = None,
+    ) -> None:
+        assert parent is None or key is not None, "The key must be provided if the parent is provided."
+        self.parent = parent
+        self.key = key
+        self.data = data
+        self.scope = scope
+        self._scope_maps = None
+
+    def __repr__(self) -> str:
+        return f"Context(key={self.key!r}, data={self.data!r}, scope={self.scope!r})"
 
     def error(self, message: str) -> "TemplateError":
         """
@@ -38,32 +58,67 @@ class Context(Generic[T_Value]):
 
     def format_location(self) -> str:
         """
-        Format the context location for human readability.
+        Format the context location for human readability. This is only needed for error messages, so it is computed
+        on demand and not cached; contexts may be reused for multiple values during evaluation.
         """
 
-        if self.parent is None:
-            return "$"
-        else:
-            assert self.key is not None
-            if isinstance(self.key, int) or (isinstance(self.key, str) and self.key.isidentifier()):
-                return f"{self.parent.format_location()}.{self.key}"
+        parts = []
+        curr: Context = self
+        while curr.parent is not None:
+            assert curr.key is not None
+            if isinstance(curr.key, int) or curr.key.isidentifier():
+                parts.append(f".{curr.key}")
             else:
-                return f"{self.parent.format_location()}.'{self.key}'"
+                parts.append(f".'{curr.key}'")
+            curr = curr.parent
 
-    def full_scope(self, globals_: dict[str, Any] | None = None) -> ChainMap:
+        parts.append("$")
+        return "".join(reversed(parts))
+
+    def full_scope(self, globals_: dict[str, Any] | None = None) -> Scope:
         """
-        Create a ChainMap of the scope.
+        Create a ChainMap of the scope. Variables in inner scopes shadow those of outer scopes and the [globals_].
         """
 
-        maps = []
-
+        maps = self.scope_maps()
         if globals_ is not None:
-            maps.append(globals_)
+            return Scope(*maps, globals_)
+        return Scope(*maps)
+
+    def scope_maps(self) -> list[dict[str, Any]]:
+        """
+        Return the non-empty scopes of this context and its parents, innermost first. The result is cached on every
+        context along the way, so the parent chain is walked only once for all contexts that share it. The returned
+        list must not be modified.
+        """
+
+        if self._scope_maps is not None:
+            return self._scope_maps
 
+        # Collect the contexts for which the maps have not been computed yet.
+        pending: list[Context] = []
         curr: Context | None = self
-        while curr:
-            if curr.scope:
-                maps.append(curr.scope)
+        while curr is not None and curr._scope_maps is None:
+            pending.append(curr)
             curr = curr.parent
 
-        return ChainMap(*maps)
+        maps = [] if curr is None or curr._scope_maps is None else curr._scope_maps
+        for ctx in reversed(pending):
+            if ctx.scope:
+                maps = [ctx.scope, *maps]
+            ctx._scope_maps = maps
+
+        return maps
+
+
+class Scope(ChainMap[str, Any]):
+    """
+    A ChainMap that avoids raising and catching a `KeyError` for every map that does not contain a key on lookup.
+    Used as the locals mapping for expressions, where misses are common (e.g. when looking up globals or builtins).
+    """
+
+    def __getitem__(self, key: str) -> Any:
+        for mapping in self.maps:
+            if key in mapping:
+                return mapping[key]
+        return self.__missing__(key)
@@ -1,9 +1,183 @@
-from collections.abc import Iterable
+import builtins
+from collections.abc import Callable
+import dis
+from functools import lru_cache
+import keyword
 import re
-from typing import Any, cast
+from types import CodeType
+from typing import Any, NamedTuple, NoReturn, cast
 
-from structured_templates.context import Context
-from structured_templates.types import Value
+from structured_templates.context import Context, Scope
+from structured_templates.exceptions import TemplateError
+from structured_templates.types import CompiledTemplate, Value
+
+
+_TEMPLATE_RE = re.compile(r"\$\{\{([^}\n]+(?:\}(?!\})[^}\n]*)*)\}\}")
+""" Matches a `${{ ... }}` substitution in a string. Written to scan up to the closing `}}` without backtracking. """
+
+_PlainValue = int | float | str | bool | None
+""" Values that can be substituted into a string. """
+
+_Node = Callable[[Context[Any] | None, dict[str, Any]], Any]
+""" A compiled template value. Evaluates the value given the context of its parent and the variables in scope. """
+
+_Mapping = Callable[[Context[Any], dict[str, Any]], Any]
+""" A compiled mapping. Evaluates the mapping given its own context and the variables in scope. """
+
+_Entry = Callable[[Context[Any], dict[str, Any], dict[str, Value]], None]
+"""
+A compiled mapping entry. Evaluates the entry given the context of the mapping and the variables in scope and adds
+it to the result mapping.
+"""
+
+
+class _CompiledExpression(NamedTuple):
+    code: CodeType
+    """ The compiled expression. """
+
+    has_nested_scopes: bool
+    """
+    Whether the expression contains nested scopes (comprehensions, lambdas). Names in nested scopes are resolved
+    only against the globals, so such expressions need the scope merged into the globals.
+    """
+
+    has_assignments: bool
+    """ Whether the expression assigns variables (`:=`), which eval() writes into the locals mapping. """
+
+    name: str | None
+    """
+    Set if the expression is only a variable name, the most common kind of expression. Looking it up directly is
+    much cheaper than calling eval().
+    """
+
+
+@lru_cache(maxsize=1024)
+def _compile_expression(source: str) -> _CompiledExpression:
+    """
+    Compile an expression for evaluation. The result is cached because the same expression is commonly evaluated
+    many times, e.g. in the body of a `for()` block.
+    """
+
+    # eval() strips leading spaces and tabs from source strings, compile() does not.
+    code = compile(source.lstrip(" \t"), "<structured_templates>", "eval")
+    has_nested_scopes = any(isinstance(const, CodeType) for const in code.co_consts)
+    has_assignments = any(instr.opname == "STORE_NAME" for instr in dis.get_instructions(code))
+    name = source.strip()
+    is_name = name.isidentifier() and not keyword.iskeyword(name)
+    return _CompiledExpression(code, has_nested_scopes, has_assignments, name if is_name else None)
+
+
+@lru_cache(maxsize=1024)
+def _parse_key(key: str) -> tuple[str, ...]:
+    """
+    Parse a mapping key into the kind of control element it represents and its arguments, e.g. `("for", var,
+    iterable)` for `for(var in iterable)` or `("key",)` for a plain key. The result is cached because the same keys
+    are commonly evaluated many times. Raises a `ValueError` if the control element is malformed.
+    """
+
+    if not key.endswith(")"):
+        return ("key",)
+
+    if key.startswith("if("):
+        return ("if", key[3:-1])
+
+    if key.startswith("for("):
+        expr = key[4:-1]  # TODO: Better parsing of the for block syntax
+        if " in " not in expr:
+            raise ValueError(f"Invalid for block expression (missing 'in'): {expr}")
+
+        var, iterable = expr.split(" in ", 1)
+        if not var.isidentifier():
+            raise ValueError(f"Invalid for block variable (not an identifier): {var}")
+
+        return ("for", var, iterable)
+
+    if key.startswith("with("):
+        # TODO: Support multiple assignments
+        expr = key[5:-1]
+        if "=" not in expr:
+            raise ValueError(f"Invalid with block expression (missing '='): {expr}")
+
+        var, val = expr.split("=", 1)
+        if not var.isidentifier():
+            raise ValueError(f"Invalid with block variable (not an identifier): {var}")
+
+        return ("with", var, val)
+
+    if key == "merge()":
+        return ("merge",)
+
+    if key == "concat()":
+        return ("concat",)
+
+    return ("key",)
+
+
+@lru_cache(maxsize=1024)
+def _parse_string(value: str) -> str | tuple[str, ...]:
+    """
+    Split a string that contains substitutions. Returns the expression if the string consists of a single
+    substitution, which evaluates to the value of the expression as-is. Otherwise returns a tuple that alternates
+    between literal text and expressions, starting and ending with literal text.
+    """
+
+    if value.startswith("${{") and value.endswith("}}") and value.find("${{", 3) == -1:
+        return value[3:-2]
+
+    parts: list[str] = []
+    last = 0
+    for match in _TEMPLATE_RE.finditer(value):
+        parts.append(value[last : match.start()])
+        parts.append(match.group(1))
+        last = match.end()
+    parts.append(value[last:])
+
+    return tuple(parts)
+
+
+# Errors shared by evaluated and compiled templates. They take the context of the offending value, which only needs
+# to be created once an error occurs.
+
+
+def _expression_error(ctx: Context[Any], error: Exception) -> TemplateError:
+    return ctx.error(f"Failed to evaluate the expression: {error}")
+
+
+def _plain_value_error(ctx: Context[Any], value: Any) -> TemplateError:
+    return ctx.error(f"Expected a plain value, got {type(value).__name__}")
+
+
+def _key_error(ctx: Context[Any], key: Any) -> TemplateError:
+    return ctx.error(f"Expected a string key, got {type(key).__name__}")
+
+
+def _block_value_error(ctx: Context[Any], block: str) -> TemplateError:
+    article = "an" if block == "if" else "a"
+    return ctx.error(f"The value of {article} {block} block must be a dictionary.")
+
+
+def _block_result_error(ctx: Context[Any], block: str, value: Any) -> TemplateError:
+    return ctx.error(f"{block}() must evaluate to a mapping, got {type(value).__name__}")
+
+
+def _iterable_error(ctx: Context[Any], value: Any) -> TemplateError:
+    return ctx.error(f"The iterable of a for block must be iterable, got {type(value).__name__}.")
+
+
+def _merge_item_error(ctx: Context[Any], item: Any) -> TemplateError:
+    return ctx.error(f"Expected a dictionary, got {type(item).__name__}")
+
+
+def _concat_keys_error(ctx: Context[Any], keys: Any) -> TemplateError:
+    return ctx.error(f"concat() can only be used in a mapping with one key, got {keys}")
+
+
+def _concat_value_error(ctx: Context[Any], value: Any) -> TemplateError:
+    return ctx.error(f"concat() value must be a list, got {type(value).__name__}")
+
+
+def _concat_item_error(ctx: Context[Any], idx: int, item: Any) -> TemplateError:
+    return ctx.error(f"item {idx} to concat() must be a list, got {type(item).__name__}")
 
 
 class TemplateEngine:
@@ -12,7 +186,12 @@ class TemplateEngine:
     """
 
     def __init__(self, globals_: dict[str, Any] | None = None):
-        self.globals = globals_ or {}
+        # The globals are used by reference, later changes by the caller are visible to expressions. They are looked
+        # up through the locals mapping because eval() would insert `__builtins__` into a globals dictionary.
+        self.globals = globals_ if globals_ is not None else {}
+
+        # Callers can pass their own `__builtins__` to restrict the functions available to expressions.
+        self._eval_globals = {"__builtins__": self.globals.get("__builtins__", builtins.__dict__)}
 
     def evaluate(self, value: Value | Context[Value], recursive: bool = True) -> Value:
         """
@@ -20,17 +199,28 @@ class TemplateEngine:
         """
 
         if not isinstance(value, Context):
+            if not isinstance(value, dict | list | str):
+                return value
             value = Context(None, None, value)
 
-        match value.data:
-            case dict():
-                return self.evaluate_dict(cast(Context[dict[str, Value]], value), recursive)
-            case list():
-                return self.evaluate_list(cast(Context[list[Value]], value), recursive)
-            case str():
-                return self.evaluate_string(cast(Context[str], value))
-            case _:
-                return value.data
+        # Dispatch on the exact type, only subclasses of the built-in types need the slower isinstance() checks.
+        data = value.data
+        kind: type = type(data)
+        if kind is not str and kind is not dict and kind is not list:
+            if isinstance(data, str):
+                kind = str
+            elif isinstance(data, dict):
+                kind = dict
+            elif isinstance(data, list):
+                kind = list
+            else:
+                return data
+
+        if kind is str:
+            return self.evaluate_string(cast(Context[str], value))
+        if kind is dict:
+            return self.evaluate_dict(cast(Context[dict[str, Value]], value), recursive)
+        return self.evaluate_list(cast(Context[list[Value]], value), recursive)
 
     def evaluate_dict(self, ctx: Context[dict[str, Value]], recursive: bool) -> dict[str, Value] | list[Value]:
         """
@@ -39,134 +229,450 @@ class TemplateEngine:
 
         result: dict[str, Value] = {}
         for key, value in ctx.data.items():
-            subctx = Context(ctx, key, value)
+            try:
+                directive = _parse_key(key)
+            except ValueError as e:
+                raise Context(ctx, key, value).error(str(e)) from None
+
+            # Plain keys are the most common case, don't allocate contexts for them unless needed.
+            if directive[0] == "key":
+                key_value = key
+                if "${{" in key:
+                    evaluated_key = self.evaluate_string(Context(ctx, key, key))
+                    if not isinstance(evaluated_key, str):
+                        raise _key_error(Context(ctx, key, value), evaluated_key)
+                    key_value = evaluated_key
+                # Other values evaluate to themselves, don't allocate a context for them.
+                if isinstance(value, str) or (recursive and isinstance(value, dict | list)):
+                    value = self.evaluate(Context(ctx, key, value), recursive)
+                result[key_value] = value
+                continue
 
-            if key.startswith("if(") and key.endswith(")"):
-                if self.evaluate_expression(Context(ctx, key, key[3:-1])):
-                    # We require a dict, but if it's a string we want to evaluate it first.
-                    if isinstance(value, str):
-                        value = self.evaluate_string(Context(ctx, key, value))
+            subctx = Context(ctx, key, value)
+            match directive:
+                case ("if", condition):
+                    if self.evaluate_expression(Context(ctx, key, condition)):
+                        # We require a dict, but if it's a string we want to evaluate it first.
+                        if isinstance(value, str):
+                            value = self.evaluate_string(Context(ctx, key, value))
+                        if not isinstance(value, dict):
+                            raise _block_value_error(subctx, "if")
+
+                        if recursive:
+                            value = self.evaluate_dict(Context(ctx, key, value), recursive)
+
+                        if not isinstance(value, dict):
+                            raise _block_result_error(subctx, "if", value)
+                        result.update(value)
+
+                case ("for", var, iterable):
+                    if not isinstance(value, dict):
+                        raise _block_value_error(subctx, "for")
+
+                    it = self.evaluate_expression(Context(ctx, key, iterable))
+                    try:
+                        iterator = iter(it)
+                    except TypeError:
+                        raise _iterable_error(subctx, it) from None
+
+                    # The body context and its scope are reused across iterations, nothing retains them after the
+                    # body is evaluated (except for a raised error, which ends the loop).
+                    scope: dict[str, Any] = {}
+                    body_ctx = Context(subctx, "0", value, scope)
+
+                    for idx, item in enumerate(iterator):
+                        if not recursive:
+                            result[f"with({var}={item!r})"] = value
+                        else:
+                            scope[var] = item
+                            body_ctx.key = str(idx)
+                            new_value = self.evaluate_dict(body_ctx, recursive)
+                            if not isinstance(new_value, dict):
+                                raise _block_result_error(subctx, "for", new_value)
+                            result.update(new_value)
+
+                case ("with", var, expr):
                     if not isinstance(value, dict):
-                        raise subctx.error("The value of an if block must be a dictionary.")
+                        raise _block_value_error(subctx, "with")
+
+                    val = self.evaluate_expression(Context(ctx, key, expr))
+                    new_value = self.evaluate_dict(Context(subctx, var, value, {var: val}), recursive)
+                    if not isinstance(new_value, dict):
+                        raise _block_result_error(subctx, "with", new_value)
+                    result.update(new_value)
+
+                case ("merge",):
+                    if not isinstance(value, list):
+                        value = [value]
+
+                    for item in value:
+                        item = self.evaluate(Context(ctx, key, item), recursive)
+                        if not isinstance(item, dict):
+                            raise _merge_item_error(subctx, item)
+                        result.update(item)
+
+                case ("concat",):
+                    if len(ctx.data) != 1:
+                        raise _concat_keys_error(subctx, ctx.data.keys())
+                    if not isinstance(value, list):
+                        raise _concat_value_error(subctx, value)
+
+                    new_list: list[Any] = []
+                    for idx, item in enumerate(value):
+                        if item is None:
+                            continue
+                        item = self.evaluate(Context(ctx, idx, item), recursive)
+                        if not isinstance(item, list):
+                            raise _concat_item_error(subctx, idx, item)
+                        new_list.extend(item)
+
+                    return new_list
 
-                    if recursive:
-                        value = self.evaluate_dict(Context(ctx, key, value), recursive)
+        return result
 
-                    if not isinstance(value, dict):
-                        raise subctx.error(f"if() must evaluate to a mapping, got {type(value).__name__}")
-                    result.update(value)
+    def evaluate_list(self, ctx: Context[list[Value]], recursive: bool) -> list[Value]:
+        """
+        Evaluate the given list.
+        """
 
-            elif key.startswith("for(") and key.endswith(")"):
-                if not isinstance(value, dict):
-                    raise subctx.error("The value of a for block must be a dictionary.")
+        # A single context is reused for all items, evaluation does not retain it (except for a raised error).
+        item_ctx: Context[Value] | None = None
+        result: list[Value] = []
+        for idx, item in enumerate(ctx.data):
+            # Other values evaluate to themselves, don't allocate a context for them.
+            if isinstance(item, dict | list | str):
+                if item_ctx is None:
+                    item_ctx = Context(ctx, idx, item)
+                else:
+                    item_ctx.key = idx
+                    item_ctx.data = item
+                item = self.evaluate(item_ctx, recursive)
+            result.append(item)
 
-                expr = key[4:-1]  # TODO: Better parsing of the for block syntax
-                if " in " not in expr:
-                    raise subctx.error(f"Invalid for block expression (missing 'in'): {expr}")
+        return result
+
+    def evaluate_string(self, ctx: Context[str]) -> Value:
+        """
+        Evaluate the given string.
+        """
+
+        # Most strings contain no substitutions at all, a substring search is much cheaper than a regex scan.
+        if "${{" not in ctx.data:
+            return ctx.data
+
+        parsed = _parse_string(ctx.data)
+        if isinstance(parsed, str):
+            return self.evaluate_expression(Context(ctx.parent, ctx.key, parsed))
+
+        # Every other part is an expression.
+        parts = list(parsed)
+        for idx in range(1, len(parts), 2):
+            result = self.evaluate_expression(Context(ctx.parent, ctx.key, parts[idx]))
+            if not isinstance(result, _PlainValue):
+                raise _plain_value_error(ctx, result)
+            parts[idx] = str(result) if result is not None else ""
+
+        return "".join(parts)
+
+    def evaluate_expression(self, ctx: Context[str]) -> Any:
+        """
+        Evaluate the given expression.
+        """
+
+        try:
+            code, has_nested_scopes, has_assignments, name = _compile_expression(ctx.data)
+            if name is not None:
+                for mapping in ctx.scope_maps():
+                    if name in mapping:
+                        return mapping[name]
+                if name in self.globals:
+                    return self.globals[name]
+                # Builtins and undefined names are left to eval().
+            if has_nested_scopes:
+                return eval(code, dict(ctx.full_scope(self.globals)))
+            # Assignment expressions write into the first map, which must be neither a scope of the template nor the
+            # globals.
+            scope = ctx.full_scope(self.globals)
+            return eval(code, self._eval_globals, scope.new_child() if has_assignments else scope)
+        except Exception as e:
+            raise _expression_error(ctx, e) from e
+
+    def compile(self, template: Value) -> CompiledTemplate:
+        """
+        Compile the template into a function that evaluates it with the given variables in scope. All keys are
+        parsed and all expressions are compiled once up front, so evaluating the same template repeatedly is much
+        cheaper than calling [evaluate()] every time. The result is the same as that of a recursive [evaluate()].
 
-                var, iterable = expr.split(" in ")
-                if not var.isidentifier():
-                    raise subctx.error(f"Invalid for block variable (not an identifier): {var}")
+        Values that only become a template during evaluation (an `if()` block whose value is a string that evaluates
+        to a mapping) are evaluated with [evaluate_dict()].
+        """
+
+        node = self._compile_value(None, template)
+
+        def render(scope: dict[str, Any] | None = None) -> Value:
+            # Copy the scope, evaluating the template must not modify the caller's dictionary.
+            return cast(Value, node(None, dict(scope or {})))
+
+        return render
+
+    def _compile_value(self, key: str | int | None, value: Value) -> _Node:
+        """
+        Compile a value found at the given key of its parent.
+        """
+
+        if isinstance(value, str):
+            return self._compile_string(key, value)
+        if isinstance(value, dict):
+            mapping = self._compile_mapping(value)
+            return lambda parent, locals_: mapping(Context(parent, key, value), locals_)
+        if isinstance(value, list):
+            return self._compile_list(key, value)
+        return lambda parent, locals_: value
+
+    def _compile_mapping(self, data: dict[str, Value]) -> _Mapping:
+        """
+        Compile the entries of a mapping.
+        """
+
+        if len(data) == 1 and "concat()" in data:
+            return self._compile_concat(data["concat()"])
+
+        entries = [self._compile_entry(key, value) for key, value in data.items()]
+
+        def mapping(ctx: Context[Any], locals_: dict[str, Any]) -> dict[str, Value]:
+            result: dict[str, Value] = {}
+            for entry in entries:
+                entry(ctx, locals_, result)
+            return result
+
+        return mapping
+
+    def _compile_entry(self, key: str, value: Value) -> _Entry:
+        """
+        Compile a single entry of a mapping, which is either a control element or a plain key.
+        """
+
+        try:
+            directive = _parse_key(key)
+        except ValueError as e:
+            message = str(e)
+            return self._compile_error(key, value, lambda ctx: ctx.error(message))
+
+        match directive:
+            case ("if", condition):
+                condition_node = self._compile_expression_node(key, condition)
+
+                body: _Node
+                if isinstance(value, dict):
+                    body = self._compile_value(key, value)
+                elif isinstance(value, str):
+                    string_node = self._compile_string(key, value)
+
+                    def body(parent: Context[Any] | None, locals_: dict[str, Any]) -> Any:
+                        template = string_node(parent, locals_)
+                        if not isinstance(template, dict):
+                            raise _block_value_error(Context(parent, key, value), "if")
+                        return self.evaluate_dict(Context(parent, key, template, locals_), True)
+
+                else:
+                    body = self._compile_error(key, value, lambda ctx: _block_value_error(ctx, "if"))
+
+                def if_entry(ctx: Context[Any], locals_: dict[str, Any], result: dict[str, Value]) -> None:
+                    if condition_node(ctx, locals_):
+                        new_value = body(ctx, locals_)
+                        if not isinstance(new_value, dict):
+                            raise _block_result_error(Context(ctx, key, value), "if", new_value)
+                        result.update(new_value)
 
-                it = self.evaluate_expression(Context(ctx, key, iterable))
-                if not isinstance(it, Iterable):
-                    raise subctx.error(f"The iterable of a for block must be iterable, got {type(it).__name__}.")
+                return if_entry
 
-                for idx, item in enumerate(it):
-                    if not recursive:
-                        result[f"with({var}={item!r})"] = value
-                    else:
-                        new_value = self.evaluate_dict(Context(subctx, str(idx), value, {var: item}), recursive)
+            case ("for", var, iterable):
+                if not isinstance(value, dict):
+                    return self._compile_error(key, value, lambda ctx: _block_value_error(ctx, "for"))
+
+                iterable_node = self._compile_expression_node(key, iterable)
+                for_body = self._compile_mapping(value)
+
+                def for_entry(ctx: Context[Any], locals_: dict[str, Any], result: dict[str, Value]) -> None:
+                    subctx = Context(ctx, key, value)
+                    it = iterable_node(ctx, locals_)
+                    try:
+                        iterator = iter(it)
+                    except TypeError:
+                        raise _iterable_error(subctx, it) from None
+
+                    # The body context is created for every evaluation of the block and reused across its iterations,
+                    # an error ends the loop before the key is changed again.
+                    body_ctx = Context(subctx, "0", value)
+                    scope = dict(locals_)
+                    for idx, item in enumerate(iterator):
+                        scope[var] = item
+                        body_ctx.key = str(idx)
+                        new_value = for_body(body_ctx, scope)
                         if not isinstance(new_value, dict):
-                            raise subctx.error(f"for() must evaluate to a mapping, got {type(new_value).__name__}")
+                            raise _block_result_error(subctx, "for", new_value)
                         result.update(new_value)
 
-            elif key.startswith("with(") and key.endswith(")"):
+                return for_entry
+
+            case ("with", var, expr):
                 if not isinstance(value, dict):
-                    raise subctx.error("The value of a with block must be a dictionary.")
-
-                # TODO: Support multiple assignments
-                expr = key[5:-1]
-                if "=" not in expr:
-                    raise subctx.error(f"Invalid with block expression (missing '='): {expr}")
-
-                var, val = expr.split("=")
-                if not var.isidentifier():
-                    raise subctx.error(f"Invalid with block variable (not an identifier): {var}")
-
-                val = self.evaluate_expression(Context(ctx, key, val))
-                new_value = self.evaluate_dict(Context(subctx, var, value, {var: val}), recursive)
-                if not isinstance(new_value, dict):
-                    raise subctx.error(f"with() must evaluate to a mapping, got {type(new_value).__name__}")
-                result.update(new_value)
-
-            elif key == "merge()":
-                if not isinstance(value, list):
-                    value = [value]
-
-                for item in value:
-                    item = self.evaluate(Context(ctx, key, item), recursive)
-                    if not isinstance(item, dict):
-                        raise subctx.error(f"Expected a dictionary, got {type(item).__name__}")
-                    result.update(item)
-
-            elif key == "concat()":
-                if len(ctx.data) != 1:
-                    raise subctx.error(f"concat() can only be used in a mapping with one key, got {ctx.data.keys()}")
-                if not isinstance(value, list):
-                    raise subctx.error(f"concat() value must be a list, got {type(value).__name__}")
-
-                new_list: list[Any] = []
-                for idx, item in enumerate(value):
-                    if item is None:
-                        continue
-                    item = self.evaluate(Context(ctx, idx, item), recursive)
-                    if not isinstance(item, list):
-                        raise subctx.error(f"item {idx} to concat() must be a list, got {type(value).__name__}")
-                    new_list.extend(item)
-
-                return new_list
+                    return self._compile_error(key, value, lambda ctx: _block_value_error(ctx, "with"))
 
-            else:
-                key_value = self.evaluate_string(Context(ctx, key, key))
-                if not isinstance(key_value, str):
-                    raise subctx.error(f"Expected a string key, got {type(key_value).__name__}")
-                if recursive or isinstance(value, str):
-                    value = self.evaluate(Context(ctx, key, value), recursive)
-                result[key_value] = value
+                value_node = self._compile_expression_node(key, expr)
+                with_body = self._compile_mapping(value)
 
-        return result
+                def with_entry(ctx: Context[Any], locals_: dict[str, Any], result: dict[str, Value]) -> None:
+                    subctx = Context(ctx, key, value)
+                    val = value_node(ctx, locals_)
+                    new_value = with_body(Context(subctx, var, value), {**locals_, var: val})
+                    if not isinstance(new_value, dict):
+                        raise _block_result_error(subctx, "with", new_value)
+                    result.update(new_value)
 
-    def evaluate_list(self, ctx: Context[list[Value]], recursive: bool) -> list[Value]:
+                return with_entry
+
+            case ("merge",):
+                items = value if isinstance(value, list) else [value]
+                item_nodes = [self._compile_value(key, item) for item in items]
+
+                def merge_entry(ctx: Context[Any], locals_: dict[str, Any], result: dict[str, Value]) -> None:
+                    for item_node in item_nodes:
+                        item = item_node(ctx, locals_)
+                        if not isinstance(item, dict):
+                            raise _merge_item_error(Context(ctx, key, value), item)
+                        result.update(item)
+
+                return merge_entry
+
+            case ("concat",):
+                # A mapping with only a concat() key is compiled by _compile_concat().
+                def concat_entry(ctx: Context[Any], locals_: dict[str, Any], result: dict[str, Value]) -> None:
+                    raise _concat_keys_error(Context(ctx, key, value), ctx.data.keys())
+
+                return concat_entry
+
+            case _:
+                key_node = self._compile_string(key, key)
+                value_node = self._compile_value(key, value)
+
+                def key_entry(ctx: Context[Any], locals_: dict[str, Any], result: dict[str, Value]) -> None:
+                    key_value = key_node(ctx, locals_)
+                    if not isinstance(key_value, str):
+                        raise _key_error(Context(ctx, key, value), key_value)
+                    result[key_value] = value_node(ctx, locals_)
+
+                return key_entry
+
+    def _compile_concat(self, value: Value) -> _Mapping:
         """
-        Evaluate the given list.
+        Compile the value of a mapping that consists only of a `concat()` key.
         """
 
-        return [self.evaluate(Context(ctx, idx, item), recursive) for idx, item in enumerate(ctx.data)]
+        if not isinstance(value, list):
+            return self._compile_error("concat()", value, lambda ctx: _concat_value_error(ctx, value))
 
-    def evaluate_string(self, ctx: Context[str]) -> Value:
+        item_nodes = [(idx, self._compile_value(idx, item)) for idx, item in enumerate(value) if item is not None]
+
+        def concat(ctx: Context[Any], locals_: dict[str, Any]) -> list[Value]:
+            new_list: list[Value] = []
+            for idx, item_node in item_nodes:
+                item = item_node(ctx, locals_)
+                if not isinstance(item, list):
+                    raise _concat_item_error(Context(ctx, "concat()", value), idx, item)
+                new_list.extend(item)
+            return new_list
+
+        return concat
+
+    def _compile_list(self, key: str | int | None, data: list[Value]) -> _Node:
         """
-        Evaluate the given string.
+        Compile a list found at the given key of its parent.
         """
 
-        if ctx.data.startswith("${{") and ctx.data.endswith("}}"):
-            return self.evaluate_expression(Context(ctx.parent, ctx.key, ctx.data[3:-2]))
+        item_nodes = [self._compile_value(idx, item) for idx, item in enumerate(data)]
 
-        def _repl(m: re.Match[str]) -> str:
-            result = self.evaluate_expression(Context(ctx.parent, ctx.key, m.group(1)))
-            if not isinstance(result, int | float | str | bool | None):
-                raise ctx.error(f"Expected a plain value, got {type(result).__name__}")
-            return str(result) if result is not None else ""
+        def node(parent: Context[Any] | None, locals_: dict[str, Any]) -> list[Value]:
+            ctx = Context(parent, key, data)
+            return [item_node(ctx, locals_) for item_node in item_nodes]
 
-        return re.sub(r"\$\{\{(.+?)\}\}", _repl, ctx.data)
+        return node
 
-    def evaluate_expression(self, ctx: Context[str]) -> Any:
+    def _compile_string(self, key: str | int | None, data: str) -> _Node:
         """
-        Evaluate the given expression.
+        Compile a string found at the given key of its parent.
+        """
+
+        if "${{" not in data:
+            return lambda parent, locals_: data
+
+        parsed = _parse_string(data)
+        if isinstance(parsed, str):
+            return self._compile_expression_node(key, parsed)
+
+        # Every other part is an expression.
+        parts = [part if idx % 2 == 0 else self._compile_expression_node(key, part) for idx, part in enumerate(parsed)]
+
+        def node(parent: Context[Any] | None, locals_: dict[str, Any]) -> str:
+            result: list[str] = []
+            for part in parts:
+                if isinstance(part, str):
+                    result.append(part)
+                    continue
+                value = part(parent, locals_)
+                if not isinstance(value, _PlainValue):
+                    raise _plain_value_error(Context(parent, key, data), value)
+                result.append(str(value) if value is not None else "")
+            return "".join(result)
+
+        return node
+
+    def _compile_expression_node(self, key: str | int | None, source: str) -> _Node:
+        """
+        Compile an expression found at the given key of its parent.
         """
 
         try:
-            # TODO: Don't manifest full ChainMap, this is a huge performance hit.
-            return eval(ctx.data, dict(ctx.full_scope(self.globals)))
-        except Exception as e:
-            raise ctx.error(f"Failed to evaluate the expression: {e}") from e
+            code, has_nested_scopes, has_assignments, name = _compile_expression(source)
+        except (SyntaxError, ValueError) as e:
+            # Like evaluate(), report invalid expressions only if they are evaluated.
+            error = e
+
+            def fail(parent: Context[Any] | None, locals_: dict[str, Any]) -> NoReturn:
+                raise _expression_error(Context(parent, key, source), error) from error
+
+            return fail
+
+        globals_ = self.globals
+        eval_globals = self._eval_globals
+
+        def node(parent: Context[Any] | None, locals_: dict[str, Any]) -> Any:
+            try:
+                if name is not None:
+                    if name in locals_:
+                        return locals_[name]
+                    if name in globals_:
+                        return globals_[name]
+                if has_nested_scopes:
+                    return eval(code, {**globals_, **locals_})
+                # Assignment expressions must write into neither the scope of the template nor the globals.
+                scope = Scope({}, locals_, globals_) if has_assignments else Scope(locals_, globals_)
+                return eval(code, eval_globals, scope)
+            except Exception as e:
+                raise _expression_error(Context(parent, key, source), e) from e
+
+        return node
+
+    @staticmethod
+    def _compile_error(
+        key: str | int | None, value: Any, error: Callable[[Context[Any]], TemplateError]
+    ) -> Callable[..., NoReturn]:
+        """
+        Compile an error that is raised only when the value is evaluated, like it would be with [evaluate()]. The
+        returned function is called with the context of the value's parent first.
+        """
+
+        def fail(parent: Context[Any] | None, *args: Any) -> NoReturn:
+            raise error(Context(parent, key, value))
+
+        return fail
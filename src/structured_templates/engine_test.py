@@ -1,5 +1,13 @@
+from collections import OrderedDict
+import inspect
+import re
 from typing import Any
+
+import pytest
+
 from structured_templates import TemplateEngine
+from structured_templates.engine import _parse_key
+from structured_templates.exceptions import TemplateError
 
 
 def test_dict_if_condition() -> None:
@@ -162,3 +170,282 @@ def test_concat() -> None:
             {"id": "c"},
         ]
     }
+
+
+def test_invalid_expression() -> None:
+    engine = TemplateEngine()
+    with pytest.raises(TemplateError) as excinfo:
+        engine.evaluate({"key": "${{ 1 + }}"})
+    assert "Failed to evaluate the expression" in str(excinfo.value)
+
+
+def test_scope_shadows_globals() -> None:
+    engine = TemplateEngine({"i": 42, "x": 2})
+
+    template = {
+        "for(i in range(2))": {
+            "a${{i}}": "${{ [i * x for _ in range(2)] }}",
+        }
+    }
+
+    result = engine.evaluate(template)
+    assert result == {"a0": [0, 0], "a1": [2, 2]}
+
+
+def test_globals_by_reference() -> None:
+    globals_ = {"a": 1}
+    engine = TemplateEngine(globals_)
+    globals_["x"] = 5
+
+    assert engine.evaluate("${{ x }}") == 5
+
+
+def test_globals_not_modified() -> None:
+    globals_ = {"x": 1}
+    engine = TemplateEngine(globals_)
+    template = {"a": "${{ x + 1 }}", "b": "${{ (y := x) }}", "c": "${{ [x for _ in range(1)] }}"}
+
+    assert engine.evaluate(template) == {"a": 2, "b": 1, "c": [1]}
+    assert engine.compile(template)() == {"a": 2, "b": 1, "c": [1]}
+    assert globals_ == {"x": 1}
+
+
+def test_assignment_expression_does_not_leak() -> None:
+    engine = TemplateEngine()
+    template = {"for(i in range(3))": {"a${{i}}": "${{ (z := i) if i == 0 else z }}"}}
+
+    with pytest.raises(TemplateError) as excinfo:
+        engine.evaluate(template)
+    assert "name 'z' is not defined" in str(excinfo.value)
+
+
+def test_nested_for_blocks() -> None:
+    engine = TemplateEngine()
+
+    template = {
+        "for(i in range(2))": {
+            "for(j in range(2))": {
+                "a${{i}}${{j}}": "${{ i * 10 + j }}",
+            },
+        },
+    }
+
+    result = engine.evaluate(template)
+    assert result == {"a00": 0, "a01": 1, "a10": 10, "a11": 11}
+
+
+def test_for_block_static_body() -> None:
+    engine = TemplateEngine()
+
+    template: dict[str, Any] = {
+        "for(i in range(3))": {
+            "a": {"b": [1, "c"]},
+        },
+        "for(i in range(0))": {
+            "d": 1,
+        },
+    }
+
+    result = engine.evaluate(template)
+    assert result == {"a": {"b": [1, "c"]}}
+    assert result["a"] is not template["for(i in range(3))"]["a"]
+
+
+def test_invalid_control_element() -> None:
+    engine = TemplateEngine()
+
+    with pytest.raises(TemplateError) as excinfo:
+        engine.evaluate({"a": {"for(i of range(3))": {}}})
+    assert (
+        str(excinfo.value) == "at $.a.'for(i of range(3))': Invalid for block expression (missing 'in'): i of range(3)"
+    )
+
+    with pytest.raises(TemplateError) as excinfo:
+        engine.evaluate({"with(1=2)": {}})
+    assert "Invalid with block variable (not an identifier): 1" in str(excinfo.value)
+
+
+def test_for_block_error_location() -> None:
+    engine = TemplateEngine()
+
+    with pytest.raises(TemplateError) as excinfo:
+        engine.evaluate({"for(i in range(3))": {"a": "${{ 1 // (i - 1) }}"}})
+    assert str(excinfo.value).startswith("at $.'for(i in range(3))'.'1'.a: Failed to evaluate the expression")
+
+
+def test_string_substitutions() -> None:
+    engine = TemplateEngine({"a": 1, "b": "x"})
+
+    assert engine.evaluate("${{ a }}-${{ b }}") == "1-x"
+    assert engine.evaluate("${{ {'k': {'v': a}} }}") == {"k": {"v": 1}}
+    assert engine.evaluate("[${{ {a}.pop() }}]") == "[1]"
+    assert engine.evaluate("${{ None }}${{ b }}") == "x"
+
+
+def test_builtin_subclasses() -> None:
+    class MyStr(str):
+        pass
+
+    engine = TemplateEngine()
+
+    template: Any = OrderedDict([("a", MyStr("${{ 1 + 1 }}"))])
+    assert engine.evaluate(template) == {"a": 2}
+
+
+def test_restricted_builtins() -> None:
+    engine = TemplateEngine({"__builtins__": {"len": len}})
+
+    assert engine.evaluate("${{ len('ab') }}") == 2
+    with pytest.raises(TemplateError) as excinfo:
+        engine.evaluate("${{ open }}")
+    assert "name 'open' is not defined" in str(excinfo.value)
+
+
+def test_for_block_not_iterable() -> None:
+    engine = TemplateEngine()
+
+    with pytest.raises(TemplateError) as excinfo:
+        engine.evaluate({"for(i in 42)": {}})
+    assert "The iterable of a for block must be iterable, got int." in str(excinfo.value)
+
+
+def test_control_element_expressions_with_separators() -> None:
+    engine = TemplateEngine({"items": ["a", "b"]})
+
+    template = {
+        "for(x in [i for i in items if i in 'ab'])": {
+            "${{ x }}": "${{ x }}",
+        },
+        "with(y=1 == 1)": {
+            "c": "${{ y }}",
+        },
+    }
+
+    result = engine.evaluate(template)
+    assert result == {"a": "a", "b": "b", "c": True}
+
+
+def test_list_error_location() -> None:
+    engine = TemplateEngine()
+
+    with pytest.raises(TemplateError) as excinfo:
+        engine.evaluate({"a": [1, "b", {"c": "${{ d }}"}]})
+    assert str(excinfo.value) == "at $.a.2.c: Failed to evaluate the expression: name 'd' is not defined"
+
+
+def test_compile() -> None:
+    engine = TemplateEngine({"x": 2, "mydict": {"a": 42}, "subtemplate": {"b": "${{ x }}"}})
+
+    templates: list[Any] = [
+        {"if(True)": {"a": 42}, "if(False)": {"b": "${{ idontexist }}"}},
+        {"for(i in range(3))": {"key${{i}}": "value${{i}}", "static": [1, "a"]}},
+        {"for(i in range(2))": {"for(j in range(2))": {"a${{i}}${{j}}": "${{ [i * x + j for _ in range(2)] }}"}}},
+        {"with(y=x + 1)": {"y": "${{ y }}"}},
+        {"if(True)": "${{ subtemplate }}", "merge()": ["${{ mydict }}", {"c": 3}]},
+        {"a": {"concat()": [["a"], None, "${{ [x] }}"]}},
+        ["${{ 1 + 1 }}", "${{ x }}-${{ None }}", 3, None],
+    ]
+
+    for template in templates:
+        assert engine.compile(template)() == engine.evaluate(template)
+
+
+def test_compile_error_parity() -> None:
+    engine = TemplateEngine({"x": 2})
+
+    # A value of the wrong type and a value that evaluates to the wrong type for every kind of key.
+    values: dict[str, tuple[Any, Any]] = {
+        "a": ("${{ 1 + }}", "prefix${{ [x] }}"),
+        "if(True)": (42, {"concat()": [[1]]}),
+        "for(i in range(1))": ([1], {"concat()": [[1]]}),
+        "with(y=x)": (42, {"concat()": [[1]]}),
+        "merge()": ("${{ x }}", [{"a": 1}, ["b"]]),
+        "concat()": (42, [[1], "${{ x }}"]),
+    }
+
+    # Both evaluate() and compile() must handle every kind of key in the table.
+    kinds = {_parse_key(key)[0] for key in values}
+    for method in (TemplateEngine.evaluate_dict, TemplateEngine._compile_entry):
+        assert {"key", *re.findall(r'case \("(\w+)"', inspect.getsource(method))} == kinds
+
+    templates: list[Any] = [{key: value} for key, pair in values.items() for value in pair]
+    templates += [
+        {"a": ["${{ y }}"]},
+        {"a": {"${{ x }}": 1}},
+        {"if(True)": "${{ x }}"},
+        {"for(i in x)": {}},
+        {"a": 1, "concat()": []},
+        {"b": {"for(i)": {}}},
+    ]
+
+    for template in templates:
+        with pytest.raises(TemplateError) as expected:
+            engine.evaluate(template)
+        with pytest.raises(TemplateError) as actual:
+            engine.compile(template)()
+        assert str(actual.value) == str(expected.value)
+
+
+def test_compile_scope() -> None:
+    engine = TemplateEngine({"x": 2})
+    render = engine.compile({"a": "${{ x * y }}", "for(i in range(y))": {"b${{i}}": "${{ i }}"}})
+
+    assert render({"y": 1}) == {"a": 2, "b0": 0}
+    assert render({"y": 2, "x": 3}) == {"a": 6, "b0": 0, "b1": 1}
+
+
+def test_compile_errors() -> None:
+    engine = TemplateEngine()
+    render = engine.compile({"for(i in range(3))": {"a": "${{ 1 // (i - 1) }}"}, "if(False)": {"b": "${{ 1 + }}"}})
+
+    with pytest.raises(TemplateError) as excinfo:
+        render()
+    assert str(excinfo.value).startswith("at $.'for(i in range(3))'.'1'.a: Failed to evaluate the expression")
+
+    render = engine.compile({"a": 1, "concat()": []})
+    with pytest.raises(TemplateError) as excinfo:
+        render()
+    assert "concat() can only be used in a mapping with one key" in str(excinfo.value)
+
+
+def test_compile_error_location_per_render() -> None:
+    engine = TemplateEngine()
+    render = engine.compile({"for(i in range(n))": {"a": "${{ 1 // (i - bad) }}"}})
+
+    with pytest.raises(TemplateError) as first:
+        render({"n": 5, "bad": 1})
+    with pytest.raises(TemplateError) as second:
+        render({"n": 5, "bad": 3})
+
+    assert str(first.value).startswith("at $.'for(i in range(n))'.'1'.a:")
+    assert str(second.value).startswith("at $.'for(i in range(n))'.'3'.a:")
+
+
+def test_compile_does_not_modify_scope() -> None:
+    engine = TemplateEngine()
+    scope = {"y": 1}
+
+    assert engine.compile({"a": "${{ (w := y) }}"})(scope) == {"a": 1}
+    assert scope == {"y": 1}
+
+
+def test_name_expressions() -> None:
+    engine = TemplateEngine({"x": 1})
+    template: Any = {
+        "for(i in range(1))": {"a": "${{ i }}", "b": "${{ x }}", "c": "${{ len }}", "d": "${{ None }}"},
+    }
+
+    assert engine.evaluate(template) == {"a": 0, "b": 1, "c": len, "d": None}
+    assert engine.compile(template)() == {"a": 0, "b": 1, "c": len, "d": None}
+
+    with pytest.raises(TemplateError) as excinfo:
+        engine.evaluate("${{ y }}")
+    assert "name 'y' is not defined" in str(excinfo.value)
+
+
+def test_non_string_key() -> None:
+    engine = TemplateEngine()
+
+    with pytest.raises(TemplateError) as excinfo:
+        engine.evaluate({"a": {"${{ 1 }}": 2}})
+    assert str(excinfo.value) == "at $.a.'${{ 1 }}': Expected a string key, got int"
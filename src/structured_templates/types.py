@@ -1,5 +1,13 @@
-from typing import Any, TypeVar
+from typing import Any, Protocol, TypeVar
 
 
 Value = dict[str, Any] | list[Any] | str | int | float | bool | None
 T_Value = TypeVar("T_Value", bound=Value)
+
+
+class CompiledTemplate(Protocol):
+    """
+    A template compiled with [TemplateEngine.compile()]. Evaluates the template with the given variables in scope.
+    """
+
+    def __call__(self, scope: dict[str, Any] | None = None) -> Value: ...